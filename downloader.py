@@ -1,155 +1,198 @@
 from bs4 import BeautifulSoup
 from pyfzf.pyfzf import FzfPrompt
 from Crypto.Cipher import AES
-from urllib.parse import urlparse
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import json
 import urllib3
 import os
 import re
 import threading
+import struct
 import shutil
 import subprocess
 import datetime
 import time
 import argparse
-from notify import notification
-fzf = FzfPrompt()
+import logging
 script_path = os.getcwd()
+anime_list_path = os.path.join(script_path, "animelist.txt")
+my_anime_list_path = os.path.join(script_path, "myanimelist.txt")
 max_episodes = 12
+# animelist.txt is reused for a day before the full list is scraped again
+anime_list_max_age = 24 * 60 * 60
 app = "Animepahe-dl"
+base_url = "https://animepahe.com"
+anime_list_url = base_url + "/anime/"
+search_url = base_url + "/api?m=search&q={}"
+release_url = base_url + "/api?m=release&id={}&sort=episode_asc&page={}"
+play_url = base_url + "/play/{}/{}"
+airing_url = base_url + "/api?m=airing&page=1"
+logger = logging.getLogger(app)
+key_cache = {}
+source_cache = {}
+session_index = {}
+source_pattern = re.compile("const source='(.*?)';")
+script_pattern = re.compile(r"<script[^>]*>(.*?)</script>", re.S)
+packer_pattern = re.compile(
+    r"}\('(.*)',\s*(\d+),\s*(\d+),\s*'(.*?)'\.split\('\|'\)", re.S)
+packer_word_pattern = re.compile(r"\b\w+\b", re.ASCII)
+# Digits used by the packer for bases up to 62
+packer_digits = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+key_uri_pattern = re.compile('URI="([^"]*)"')
+key_iv_pattern = re.compile("IV=0x([0-9a-fA-F]+)")
+# Characters not allowed in folder names are replaced with an underscore
+folder_name_table = str.maketrans(dict.fromkeys('/<>:\\?|*', "_"))
+# HLS default IV: the media sequence number as a 128-bit big-endian integer
+iv_packer = struct.Struct(">8xQ")
+# Read size for streamed segments, most of them fit in a single chunk
+segment_chunk_size = 1 << 20
+# urllib3 derives the exponential backoff between attempts from backoff_factor
+retry_policy = urllib3.util.Retry(
+    total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+# Shared by every page request so keep-alive connections are reused
+http = urllib3.PoolManager(
+    10,
+    maxsize=64,
+    retries=retry_policy,
+    headers={
+        "Referer": "https://kwik.cx/",
+        "Accept": "",
+        "Connection": "Keep-Alive",
+        # Only advertise what urllib3 can decode here, br needs brotli
+        "Accept-Encoding": urllib3.util.make_headers(
+            accept_encoding=True)["accept-encoding"],
+        "Accept-Language": "en-US,en;q=0.9",
+        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/103.0.0.0 Safari/537.36",
+    },
+)
+segment_pool = None
+segment_pool_size = 0
+# Connections of the segment workers, built with the pool to fit its size
+segment_http = None
+segment_pool_lock = threading.Lock()
+# Decryption output buffer of each segment worker, reused across segments
+segment_buffers = threading.local()
+# Single worker so episodes are compiled one at a time, in download order
+compile_pool = ThreadPoolExecutor(max_workers=1)
+
+
+def download(url):
+    return http.request("GET", url)
+
+
+def download_segment(url, episode_folder, key):
+    """Downloads a segment and decrypts it into the episode folder, errors
+       are reported and leave no file behind so a rerun fetches it again
 
+    Args:
+        url (str): Link of the segment
+        episode_folder (str): Folder the segment is saved into
+        key (AES): Cipher of the segment
 
-def download(url, anime_name="", episode=None, key=None):
-    if anime_name != "":
-        segment = os.path.basename(urlparse(url).path)[:-3]
-        name = get_path_episode_folder(anime_name, episode) + segment + ".ts"
-        if os.path.exists(name):
-            print("{} already Downloaded".format(segment))
-            return
-
-    http = urllib3.PoolManager(
-        10,
-        headers={
-            "Referer": "https://kwik.cx/",
-            "Accept": "",
-            "Connection": "Keep-Alive",
-            "Accept-Encoding": "gzip, deflate, br",
-            "Accept-Language": "en-US,en;q=0.9",
-            "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/103.0.0.0 Safari/537.36",
-        },
-    )
+    Returns:
+        HTTPResponse: The released response, None if the segment failed
+    """
+    segment = get_segment_name(url)[:-3]
+    name = episode_folder + segment + ".ts"
+    try:
+        r = segment_http.request("GET", url, preload_content=False)
+    except urllib3.exceptions.HTTPError as e:
+        print("Error:", e)
+        return None
+    # Statuses outside the retry list, such as 404, reach here with a body
+    # that must not be decrypted into a segment
+    if not 200 <= r.status < 300:
+        print("Error: {} returned {}".format(url, r.status))
+        r.release_conn()
+        return None
+    part_name = name + ".part"
     try:
-        r = http.request("GET", url, preload_content=False)
-    except urllib3.exceptions.BodyNotHttplibCompatible as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.ClosedPoolError as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.ConnectTimeoutError as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.DecodeError as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.DependencyWarning as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.EmptyPoolError as e:
-        print("Error:", e.reason)
+        with open(part_name, "wb", buffering=segment_chunk_size) as file:
+            # CBC keeps its state between calls, so the segment can be
+            # decrypted as it arrives as long as every call is block aligned
+            tail = b""
+            for chunk in r.stream(segment_chunk_size):
+                if tail:
+                    chunk = tail + chunk
+                cut = len(chunk) - len(chunk) % 16
+                out = get_segment_buffer(cut)[:cut]
+                key.decrypt(memoryview(chunk)[:cut], output=out)
+                file.write(out)
+                tail = chunk[cut:]
+            if tail:
+                file.write(key.decrypt(tail.ljust(16, b"0")))
     except urllib3.exceptions.HTTPError as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.HTTPWarning as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.HeaderParsingError() as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.HostChangedError() as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.IncompleteRead() as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.InsecurePlatformWarning as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.InsecureRequestWarning as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.InvalidChunkLength() as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.InvalidHeader as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.LocationParseError() as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.LocationValueError as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.MaxRetryError() as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.NewConnectionError() as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.PoolError() as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.ProtocolError as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.ProxyError() as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.ProxySchemeUnknown() as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.ProxySchemeUnsupported as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.ReadTimeoutError() as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.RequestError() as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.ResponseError as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.ResponseNotChunked as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.SNIMissingWarning as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.SSLError as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.SecurityWarning as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.SubjectAltNameWarning as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.SystemTimeWarning as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.TimeoutError as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.TimeoutStateError as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.URLSchemeUnknown() as e:
-        print("Error:", e.reason)
-    except urllib3.exceptions.UnrewindableBodyError as e:
-        print("Error:", e.reason)
-    if anime_name != "":
-        segment = os.path.basename(urlparse(url).path)[:-3]
-        name = get_path_episode_folder(anime_name, episode) + segment + ".ts"
-        data = r.data
-        total_size_in_bytes = int(r.getheader("Content-Length"))
-        block_size = 1024
-        while len(data) % 16 != 0:
-            data += b"0"
-        for data in range(len(data), 1024):
-            print(len(data), type(data))
-        with open(name, "ab") as file:
-            file.write(key.decrypt(data))
-        with tqdm(
-            desc=segment,
-            total=total_size_in_bytes,
-            unit="iB",
-            unit_scale=True,
-            unit_divisor=block_size,
-        ) as bar:
-            for d in range(len(data), block_size):
-                bar.update(len(d))
+        print("Error:", e)
+        os.remove(part_name)
+        return None
+    finally:
+        r.release_conn()
+    # Only a complete segment gets the name resuming looks for
+    os.replace(part_name, name)
     return r
 
 
+def get_segment_buffer(size):
+    """Returns the decryption buffer of the calling thread, grown if needed
+    Args:
+        size (Integer): Minimum size of the buffer in bytes
+
+    Returns:
+        memoryview: View over the whole buffer
+    """
+    buffer = getattr(segment_buffers, "buffer", None)
+    if buffer is None or len(buffer) < size:
+        buffer = memoryview(bytearray(max(size, segment_chunk_size)))
+        segment_buffers.buffer = buffer
+    return buffer
+
+
+def get_segment_name(url):
+    """Returns the file name of a segment, plain string splitting is enough
+       for the CDN urls and much cheaper than urlparse
+
+    Args:
+        url (str): Link to the segment
+
+    Returns:
+        str: Last path component of the url
+    """
+    return url.partition("?")[0].rpartition("/")[2]
+
+
 def anime_name_folder(anime_name):
-    temp = anime_name
-    temp = temp.replace("/", "_")
-    temp = temp.replace("<", "_")
-    temp = temp.replace(">", "_")
-    temp = temp.replace(":", "_")
-    temp = temp.replace("\\", "_")
-    temp = temp.replace("?", "_")
-    temp = temp.replace("|", "_")
-    temp = temp.replace("*", "_")
-    return temp
+    return anime_name.translate(folder_name_table)
+
+
+def write_atomic(file_path, data):
+    """Writes data in one go to a temporary file and renames it over
+       file_path, so a reader never sees a half written file
+
+    Args:
+        file_path (str): File to write
+        data (str): Full content of the file
+    """
+    temp_path = file_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(data)
+    os.replace(temp_path, file_path)
+
+
+def is_fresh(file_path, max_age):
+    """Checks the age of a cached file from its mtime, without reading it
+
+    Args:
+        file_path (str): File to check
+        max_age (Integer): Maximum age in seconds
+
+    Returns:
+        bool: True if the file exists and is younger than max_age
+    """
+    try:
+        return time.time() - os.stat(file_path).st_mtime <= max_age
+    except FileNotFoundError:
+        return False
 
 
 def get_path(anime_name):
@@ -175,17 +218,19 @@ def download_anime_list():
     """
     Parse animepahe.com/anime to retrieve all the anime name with their UUID
     """
-    url = "https://animepahe.com/anime/"
+    url = anime_list_url
     # r = brotli.decompress(download(url).data)
     r = download(url)
     soup = BeautifulSoup(r.data, "html.parser")
     divContainer = soup.find_all("div", {"class": "tab-content"})
-    with open("animelist.txt", "w") as f:
-        for tag in divContainer:
-            for tags in tag.find_all("a"):
-                uuid = tags.attrs['href'].removeprefix('/anime/')
-                name = tags.text.strip()
-                f.write("{}::::{}\n".format(uuid, name))
+    anime_list = [
+        "{}::::{}\n".format(
+            tags.attrs['href'].removeprefix('/anime/'), tags.text.strip())
+        for tag in divContainer
+        for tags in tag.find_all("a")
+    ]
+    with open(anime_list_path, "w") as f:
+        f.writelines(anime_list)
 
 
 def get_video_episode(anime_name, episode):
@@ -198,45 +243,60 @@ def get_video_episode(anime_name, episode):
     Returns:
         path: Return the path with the name of the file to be downloaded
     """
-    global max_episodes
-    name = get_path(anime_name) + "/" + anime_name + \
-        " Episode " + str(episode) + ".mp4"
+    return "{}/{} Episode {}.mp4".format(get_path(anime_name), anime_name,
+                                          episode)
+
+
+def list_anime_folder(anime_name):
+    """Returns the names of the files in the folder of an anime, read with a
+       single scandir instead of one stat per episode
 
-    return name
+    Args:
+        anime_name (str): Name of the anime
+
+    Returns:
+        set: File names present in the folder
+    """
+    try:
+        with os.scandir(get_path(anime_name)) as entries:
+            return {entry.name for entry in entries}
+    except FileNotFoundError:
+        return set()
 
 
 def add_anime_to_myanimelist(anime_name):
     """Adds an anime name to the myanimelist file, after prompting the user to confirm"""
-    with open(os.path.join(script_path, 'myanimelist.txt'), 'a+', encoding='utf-8') as f:
+    with open(my_anime_list_path, 'a+', encoding='utf-8') as f:
         f.seek(0)
-        if anime_name in f.read():
+        if anime_name in (line.rstrip("\n") for line in f):
             print(f"{anime_name} already present")
             return
-    print("Do you want to add {} to myanimelist.txt? (y/n)".format(anime_name))
-    response = input().strip().lower()
-    if response == 'y':
-        with open(os.path.join(script_path, 'myanimelist.txt'), 'a+', encoding='utf-8') as f:
+        print("Do you want to add {} to myanimelist.txt? (y/n)".format(anime_name))
+        response = input().strip().lower()
+        if response == 'y':
+            # a+ always appends, whatever position the read left us at
             f.write(f"{anime_name}\n")
             print(f"{anime_name} added to myanimelist")
-    else:
-        print(f"{anime_name} not added to myanimelist")
+        else:
+            print(f"{anime_name} not added to myanimelist")
 
 
 def search_anime_name(anime=""):
-    anime_list = []
     if anime != "":
         anime = anime.replace(" ", "%20")
-        res = "https://animepahe.com/api?m=search&q={}".format(anime)
+        res = search_url.format(anime)
         data = json.loads(download(res).data)
         # print(data)
 
-        for element in data["data"]:
-            uuid = element['session']
-            name = element['title']
-            anime_list.append("{}::::{}".format(uuid, name))
+        anime_list = [
+            "{}::::{}".format(element['session'], element['title'])
+            for element in data["data"]
+        ]
     else:
-        anime_list = open("animelist.txt", "r").readlines()
-    result = fzf.prompt(anime_list)[0]
+        if not is_fresh(anime_list_path, anime_list_max_age):
+            download_anime_list()
+        anime_list = open(anime_list_path, "r").readlines()
+    result = FzfPrompt().prompt(anime_list)[0]
     anime_slug, anime_name = result.split("::::")
     # Adding names to myanimelist
     add_anime_to_myanimelist(anime_name)
@@ -244,35 +304,73 @@ def search_anime_name(anime=""):
 
 
 def get_source_file(anime_name, anime_slug):
-    res = "https://animepahe.com/api?m=release&id={}".format(anime_slug)
-    data = download(res)
-    data = json.loads(download(res).data)
-    pages = data["last_page"]
-    episode_list = []
-    for i in range(1, pages+1):
-        res = (
-            "https://animepahe.com/api?m=release&id={}&sort=episode_asc&page={}".format(
-                anime_slug, i
-            )
-        )
-        data = json.loads(download(res).data)["data"]
-        episode_list += data
+    def get_page(page):
+        res = release_url.format(anime_slug, page)
+        return json.loads(download(res).data)
+
+    first = get_page(1)
+    pages = first["last_page"]
+    # The first page already told how many there are, fetch the rest at once
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        rest = pool.map(lambda page: get_page(page)["data"],
+                        range(2, pages+1))
+        episode_list = []
+        for data in [first["data"], *rest]:
+            # Only the episode number and its session are ever read back
+            episode_list += [
+                {"episode": element["episode"], "session": element["session"]}
+                for element in data
+            ]
     org = {"data": episode_list}
     # print(episode_list)
     path = get_path(anime_name)
-    print(path)
-    if not os.path.exists(path):
-        os.makedirs(path)
-    with open("{}/.source.json".format(path), "w") as write_file:
-        json.dump(org, write_file)
+    logger.debug("Source file saved to %s", path)
+    os.makedirs(path, exist_ok=True)
+    write_atomic("{}/.source.json".format(path), json.dumps(org))
+    source_cache[anime_name] = episode_list
+    session_index.pop(anime_name, None)
+
+
+def load_source_file(anime_name):
+    """Returns the episode list saved by get_source_file, the file is only
+       parsed once per run
+
+    Args:
+        anime_name (str): Name of the anime
+
+    Returns:
+        list: Episodes of the anime as returned by the release api
+    """
+    if anime_name not in source_cache:
+        with open("{}/.source.json".format(get_path(anime_name)), "r") as f:
+            source_cache[anime_name] = json.load(f)["data"]
+    return source_cache[anime_name]
+
+
+def get_episode_session(anime_name, episode):
+    """Returns the session of an episode, the episode list is indexed by
+       episode number the first time an anime is looked up
+
+    Args:
+        anime_name (str): Name of the anime
+        episode (Integer): Episode to be downloaded
+
+    Returns:
+        str: Session of the episode or None if it is not in .source.json
+    """
+    if anime_name not in session_index:
+        session_index[anime_name] = {
+            element["episode"]: element["session"]
+            for element in load_source_file(anime_name)
+        }
+    return session_index[anime_name].get(episode)
 
 
 def select_episode_to_download(anime_name):
     global max_episodes
     path = get_path(anime_name)
     print("Download location ", path)
-    with open("{}/.source.json".format(path), "r") as f:
-        data = json.load(f)["data"]
+    data = load_source_file(anime_name)
     max_episodes = int(data[-1]["episode"])
     for element in data:
         print("Episode {}".format(element["episode"]))
@@ -348,101 +446,212 @@ def check_audio(buttons, selected_audio):
 
 def get_site_link(anime_name, episode, quality, audio, anime_slug, session=None):
     if session is None:
-        path = get_path(anime_name)
-        source_file = os.path.join(path, ".source.json")
-        with open(source_file, "r") as source_file:
-            data = json.load(source_file)["data"]
-        for element in data:
-            if element["episode"] == episode:
-                session = element["session"]
-                break
+        session = get_episode_session(anime_name, episode)
     if session is None:
         print("{} episode {} not found".format(anime_name, episode))
         exit()
     else:
-        res = "https://animepahe.com/play/{}/{}".format(anime_slug, session)
-        data = download(res)
+        res = play_url.format(anime_slug, session)
+        data = download(res).data
         soup = BeautifulSoup(data, "html.parser")
         buttons = soup.find_all(
             "button", attrs={"data-src": True, "data-av1": 0})
     fin = check_resolution(buttons, quality)
     fin = check_audio(fin, audio)
-    print(fin)
+    logger.debug("Matching buttons %s", fin)
     link = fin[0]['data-src']
     return link
 
 
+def unpack_script(script):
+    """Unpacks a script obfuscated with Dean Edwards' P.A.C.K.E.R., as served
+       by kwik, without running it
+
+    Args:
+        script (str): Content of the script tag
+
+    Returns:
+        str: The unpacked javascript or None if the script is not packed
+    """
+    match = packer_pattern.search(script)
+    if not match:
+        return None
+    payload, radix, count, words = match.groups()
+    radix = int(radix)
+    words = words.split("|")
+    if radix > len(packer_digits) or len(words) != int(count):
+        return None
+    values = {digit: value for value, digit in enumerate(packer_digits[:radix])}
+
+    def replace(match):
+        word = match.group(0)
+        index = 0
+        for digit in word:
+            if digit not in values:
+                return word
+            index = index * radix + values[digit]
+        return words[index] if index < len(words) and words[index] else word
+
+    payload = payload.replace("\\\\", "\\").replace("\\'", "'")
+    return packer_word_pattern.sub(replace, payload)
+
+
 def get_playlist_link(link):
-    data = download(link)
-    soup = BeautifulSoup(data, "html.parser")
-    scripts = soup.find_all("script", string=True)
-    for script in scripts:
-        sc = script.string.encode('utf-8')
-        p = subprocess.Popen(
-            ['node'], shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate(sc)
-        match = re.search("const source='(.*)';", stderr.decode('utf-8'))
+    data = download(link).data.decode("utf-8", "replace")
+    for script in script_pattern.findall(data):
+        unpacked = unpack_script(script)
+        if unpacked is None:
+            continue
+        match = source_pattern.search(unpacked)
         if match:
             source = match.group(1)
-            print(source)
+            logger.debug("Playlist link %s", source)
             return str(source)
-        else:
-            print("Source not found in output.")
-            exit()
+    print("Source not found in output.")
+    exit()
+
+
+def has_m3u8(anime_name, episode):
+    """Checks if the playlist of an episode was already fetched by a previous
+       run, in which case the play page and the kwik link need not be resolved
+
+    Args:
+        anime_name (str): Name of the anime
+        episode (Integer): Episode to be downloaded
+
+    Returns:
+        bool: True if playlist.m3u8 is present in the episode folder
+    """
+    return os.path.exists("{}playlist.m3u8".format(
+        get_path_episode_folder(anime_name, episode)))
 
 
 def get_m3u8(anime_name, episode, res):
     folder_path = get_path_episode_folder(anime_name, episode)
-    if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
-    file_path = "{}playlist.m3u8".format(
-        get_path_episode_folder(anime_name, episode))
+    os.makedirs(folder_path, exist_ok=True)
+    file_path = folder_path + "playlist.m3u8"
     if os.path.exists(file_path):
         print("m3u8 file already present")
     else:
-        data = download(res).read()
+        data = download(res).data
         with open(file_path, "wb") as f:
             f.write(data)
 
 
+def download_key(url):
+    """Returns the AES key behind url, keys are shared between the episodes of
+       a series so each one is only downloaded once per run
+
+    Args:
+        url (str): URI of the #EXT-X-KEY tag
+
+    Returns:
+        bytes: The decryption key
+
+    Raises:
+        urllib3.exceptions.HTTPError: The server did not return a key
+    """
+    if url not in key_cache:
+        r = download(url)
+        # An error page must not be cached, AES-128 keys are 16 bytes
+        if not 200 <= r.status < 300 or len(r.data) != 16:
+            raise urllib3.exceptions.HTTPError(
+                "No key at {} (status {})".format(url, r.status))
+        key_cache[url] = r.data
+    return key_cache[url]
+
+
+def get_segment_pool(threads):
+    """Returns the thread pool used to download segments. The pool is kept
+       alive across episodes and only rebuilt when the thread count changes
+    Args:
+        threads (Integer): Number of threads to use to download
+
+    Returns:
+        ThreadPoolExecutor: Pool shared by every episode
+    """
+    global segment_pool, segment_pool_size, segment_http
+    with segment_pool_lock:
+        if segment_pool is None or segment_pool_size != threads:
+            if segment_pool is not None:
+                segment_pool.shutdown(wait=True)
+                segment_http.clear()
+            # No worker is left using the old connections at this point, the
+            # new ones give every worker its own keep-alive connection
+            segment_http = urllib3.PoolManager(
+                10, maxsize=threads, retries=retry_policy,
+                headers=http.headers)
+            segment_pool = ThreadPoolExecutor(max_workers=threads)
+            segment_pool_size = threads
+        return segment_pool
+
+
+def shutdown_segment_pool():
+    global segment_pool
+    with segment_pool_lock:
+        if segment_pool is not None:
+            segment_pool.shutdown(wait=True)
+            segment_pool = None
+            segment_http.clear()
+
+
+def parse_m3u8(file_path):
+    """Reads an HLS playlist in a single pass
+
+    Args:
+        file_path (str): Path to the playlist.m3u8 file
+
+    Returns:
+        dict: key (URI of the first #EXT-X-KEY), iv (bytes or None),
+              media_sequence (Integer) and segments (list of urls)
+    """
+    playlist = {"key": None, "iv": None, "media_sequence": 0, "segments": []}
+    with open(file_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("https"):
+                playlist["segments"].append(line)
+            elif line.startswith("#EXT-X-MEDIA-SEQUENCE"):
+                playlist["media_sequence"] = int(line.split(":")[1])
+            elif (playlist["key"] is None
+                  and line.startswith("#EXT-X-KEY:METHOD")):
+                match = key_uri_pattern.search(line)
+                if match:
+                    playlist["key"] = match.group(1)
+                match = key_iv_pattern.search(line)
+                if match:
+                    playlist["iv"] = bytes.fromhex(match.group(1).zfill(32))
+    return playlist
+
+
 def download_video(anime_name, episode, u_threads=0):
     links = []
+    media_sequence = 0
+    iv = None
+    episode_folder = get_path_episode_folder(anime_name, episode)
     if u_threads != 0:
-        link = ""
-        with open(
-            "{}playlist.m3u8".format(
-                get_path_episode_folder(anime_name, episode)), "r"
-        ) as f:
-            for line in f:
-                if link == "":
-                    if re.match("^#EXT-X-KEY:METHOD", line):
-                        line = line[:-1]
-                        sep = line.split(",")
-                        link = sep[1].split("=")
-                        link = link[1].split('"')[1::2]
-                if re.match("^https", line):
-                    links.append(line[:-1])
-
-        if os.path.exists(
-            "{}file.list".format(get_path_episode_folder(anime_name, episode))
-        ):
+        playlist = parse_m3u8("{}playlist.m3u8".format(episode_folder))
+        link = playlist["key"]
+        links = playlist["segments"]
+        media_sequence = playlist["media_sequence"]
+        iv = playlist["iv"]
+
+        if os.path.exists("{}file.list".format(episode_folder)):
             print("File already exists")
         else:
             print("Creating the file")
-            with open(
-                r"{}file.list".format(
-                    get_path_episode_folder(anime_name, episode)), "w"
-            ) as fp:
+            with open(r"{}file.list".format(episode_folder), "w") as fp:
                 fp.write(
                     "\n".join(
                         str("file " + "'" +
-                            os.path.basename(urlparse(item).path) + "'")
+                            get_segment_name(item) + "'")
                         for item in links
                     )
                 )
-    print("link= ", link)
-    key = download(link[0]).read()
-    sprytor = AES.new(key, AES.MODE_CBC, IV=None)
+    logger.debug("Key link %s", link)
+    key = download_key(link)
+    # Sized on the requested threads, so episodes with fewer segments reuse it
+    pool = get_segment_pool(u_threads)
     if u_threads <= len(links):
         print("Number of threads {}".format(u_threads))
     else:
@@ -452,29 +661,43 @@ def download_video(anime_name, episode, u_threads=0):
             )
         )
         u_threads = len(links)
-    i = 0
     pbar = tqdm(desc="Downloading segments", total=len(links))
-    while i < len(links):
-        downloaded_threads = []
-        if (len(links) - i) > u_threads:
-            p = u_threads
-        else:
-            p = len(links) - i
-        for j in range(p):
-            download_thread = threading.Thread(
-                target=download, args=(
-                    links[i + j], anime_name, episode, sprytor)
-            )
-            downloaded_threads.append(download_thread)
-            download_thread.start()
-        for threads in downloaded_threads:
-            threads.join()
-        i += p
-        pbar.update(p)
+    try:
+        with os.scandir(episode_folder) as entries:
+            existing = {entry.name for entry in entries}
+    except FileNotFoundError:
+        existing = set()
+    # Keep a bounded window of futures so finished ones can be released
+    max_in_flight = 2 * u_threads
+    futures = set()
+    failed = 0
+    # Skip segments left over from an interrupted run while submitting
+    for index, link in enumerate(links):
+        segment = get_segment_name(link)[:-3]
+        if segment + ".ts" in existing:
+            pbar.update(1)
+            continue
+        if len(futures) >= max_in_flight:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            pbar.update(len(done))
+            # Re-raises anything a worker failed with, None is a segment
+            # download_segment() gave up on
+            failed += sum(future.result() is None for future in done)
+        # CBC is stateful, so every segment needs its own cipher
+        sprytor = AES.new(key, AES.MODE_CBC,
+                          iv=iv or iv_packer.pack(media_sequence + index))
+        futures.add(pool.submit(
+            download_segment, link, episode_folder, sprytor))
+    done, _ = wait(futures)
+    pbar.update(len(done))
+    failed += sum(future.result() is None for future in done)
     pbar.close()
-    compile_video(anime_name, episode)
-
-    # else:
+    if failed:
+        print("{} episode {} is incomplete, {} segments failed. Run it again "
+              "to resume".format(anime_name, episode, failed))
+        return None
+    # Compile in the background so the next episode can start downloading
+    return compile_pool.submit(compile_video, anime_name, episode)
 
 
 def compile_video(anime_name, episode):
@@ -490,14 +713,29 @@ def compile_video(anime_name, episode):
     """
     episode_folder = get_path_episode_folder(anime_name, episode)
     list_file_path = os.path.join(episode_folder, "file.list")
+    joined_path = os.path.join(episode_folder, "joined.ts")
     output_video_path = get_video_episode(anime_name, episode)
 
-    # Use ffmpeg to concatenate the segments into a video
+    # MPEG-TS segments of one rendition can be joined byte for byte, so
+    # ffmpeg only has to open a single input
+    try:
+        with open(list_file_path) as f:
+            segments = [line.strip()[6:-1] for line in f if line.strip()]
+        with open(joined_path, "wb") as joined:
+            for segment in segments:
+                with open(os.path.join(episode_folder, segment),
+                          "rb") as part:
+                    shutil.copyfileobj(part, joined, segment_chunk_size)
+    except OSError as e:
+        # The folder is kept so a rerun can fetch what is missing
+        print("Failed to join the segments: {}".format(e))
+        print("Run the download again to resume {} episode {}".format(
+            anime_name, episode))
+        return
+
     cmd = [
         "ffmpeg",
-        "-f", "concat",
-        "-safe", "0",
-        "-i", list_file_path,
+        "-i", joined_path,
         "-c:v", "copy",
         "-c:a", "aac",
         "-b:a", "256k",
@@ -512,24 +750,76 @@ def compile_video(anime_name, episode):
         print("Failed to compile the video: {}".format(e.stderr))
         print("You can try running the following command manually in the episode folder:")
         print(
-            "ffmpeg -f concat -safe 0 -i file.list -c copy -y {}".format(output_video_path))
+            "ffmpeg -i joined.ts -c copy -y {}".format(output_video_path))
         return
 
     # If the video was created successfully, delete the episode folder
     shutil.rmtree(episode_folder)
     print("{} episode {} downloaded to {}".format(
         anime_name, episode, output_video_path))
-    notification('Compilation', message='{} episode {} downloaded to {}'.format(
-        anime_name, episode, output_video_path), app_name=app)
+    send_notification('Compilation', '{} episode {} downloaded to {}'.format(
+        anime_name, episode, output_video_path))
 
 
-def updates():
-    global max_episodes
-    res = "https://animepahe.com/api?m=airing&page1"
+def send_notification(title, message):
+    """Shows a desktop notification from a separate thread, the notifier is
+       only imported on first use and a slow backend never blocks downloads
+
+    Args:
+        title (str): Title of the notification
+        message (str): Body of the notification
+    """
+    def send():
+        try:
+            from notify import notification
+        except ImportError:
+            logger.debug("notify is not installed, skipping %s", title)
+            return
+        notification(title, message=message, app_name=app)
+
+    # A daemon thread never keeps the program alive for a notification
+    threading.Thread(target=send, daemon=True).start()
+
+
+def download_episode(anime_name, episode, quality, audio, anime_slug, threads,
+                     session=None):
+    """Resolves the playlist of an episode, unless a previous run already
+       saved it, and downloads its segments
+
+    Args:
+        anime_name (str): Name of the anime
+        episode (Integer): Episode to be downloaded
+        quality (str): Quality of the video
+        audio (str): Language of the audio
+        anime_slug (str): UUID of the anime
+        threads (Integer): Number of threads to use to download
+        session (str, optional): Session of the episode, looked up in
+                                 .source.json when not given
+
+    Returns:
+        Future: Compilation of the episode, None if segments failed
+    """
+    if has_m3u8(anime_name, episode):
+        print("m3u8 file already present")
+    else:
+        link = get_site_link(anime_name, int(episode),
+                             quality, audio, anime_slug, session)
+        print("\nGot the link for the episode {} of {}\n".format(
+            episode, anime_name))
+        m3u8_link = get_playlist_link(link)
+        get_m3u8(anime_name, episode, m3u8_link)
+        print("Got the link to download")
+    return download_video(anime_name, episode, threads)
+
+
+def check_for_updates():
+    """Downloads the newly aired episodes of the anime in myanimelist.txt"""
+    res = airing_url
     data = json.loads(download(res).data)["data"]
-    with open("{}/myanimelist.txt".format(script_path)) as f:
+    with open(my_anime_list_path) as f:
         anime_list = [line.strip() for line in f]
     count = 0
+    compilations = []
     for episode in data:
         if episode["anime_title"] in anime_list:
             uuid = episode["anime_session"]
@@ -537,38 +827,40 @@ def updates():
             anime_name = episode["anime_title"]
             episode = episode["episode"]
             print("New Episode {} of {} found".format(episode, anime_name))
-            max_episode = episode
             if not (os.path.exists(get_video_episode(anime_name, episode))):
-                link = get_site_link(anime_name, int(
-                    episode), "720", "jpn", uuid, session)
-                print("\nGot the link for the episode {} of {}\n".format(
-                    episode, anime_name))
-                m3u8_link = get_playlist_link(link)
-                get_m3u8(anime_name, episode, m3u8_link)
-                print("Got the link to download",)
-                download_video(anime_name, episode, 50)
+                compilations.append(download_episode(
+                    anime_name, episode, "720", "jpn", uuid, 50, session))
                 count += 1
             else:
                 print("File Already Present")
                 continue
+    for compilation in compilations:
+        if compilation is not None:
+            compilation.result()
     if count == 0:
         print("No new episode found")
-    notification('Updates', message='No new episode found',
-                 app_name=app)
-    localtime = datetime.datetime.now()
-    new_time = localtime + datetime.timedelta(hours=5)
-    formatted_time = new_time.strftime("%I:%M:%S %p")
-    print("Sleeping for 5 hrs check after {}".format(formatted_time))
-    notification('Updates', message='Sleeping for {}'.format(formatted_time),
-                 app_name=app)
-    time.sleep(18000)
-    updates()
+        send_notification('Updates', 'No new episode found')
+
+
+def updates():
+    while True:
+        try:
+            check_for_updates()
+        except urllib3.exceptions.HTTPError as e:
+            # A failed request only skips this check, not the updater
+            print("Error:", e)
+        localtime = datetime.datetime.now()
+        new_time = localtime + datetime.timedelta(hours=5)
+        formatted_time = new_time.strftime("%I:%M:%S %p")
+        print("Sleeping for 5 hrs check after {}".format(formatted_time))
+        send_notification('Updates', 'Sleeping for {}'.format(formatted_time))
+        time.sleep(18000)
 
 
 def management():
-    with open(os.path.join(script_path, 'myanimelist.txt'), 'r') as f:
+    with open(my_anime_list_path, 'r') as f:
         data = [line.strip() for line in f.readlines()]
-    print(data)
+    logger.debug("myanimelist.txt %s", data)
     while True:
         print("Currently present in the List\n")
         for i in range(len(data)):
@@ -585,9 +877,9 @@ def management():
         # elif choice == "3":
             # print("You selected Option 3")
         elif choice == "4":
-            with open(os.path.join(script_path, 'myanimelist.txt'), 'w') as f:
-                for element in data:
-                    f.write(str(element) + '\n')
+            # The updater may be reading the list from another process
+            write_atomic(my_anime_list_path,
+                         "".join(str(element) + '\n' for element in data))
             print("Goodbye!")
             break
         else:
@@ -600,36 +892,43 @@ def main(args):
     elif args.management:
         management()
     else:
-        download_anime_list()
         anime_name, anime_slug = search_anime_name(args.name)
+        downloaded = list_anime_folder(anime_name)
+        if args.episodes[0] != 0 and all(
+            os.path.basename(get_video_episode(anime_name, episode))
+            in downloaded
+            for episode in args.episodes
+        ):
+            print("All selected episodes of {} already downloaded".format(
+                anime_name))
+            return
         get_source_file(anime_name, anime_slug)
         if args.episodes[0] == 0:
             episodes = select_episode_to_download(anime_name)
         else:
             episodes = args.episodes
+        # Repeats would re-enter a folder its earlier compile is removing,
+        # the downloaded listing above is not refreshed for them
+        episodes = list(dict.fromkeys(episodes))
         print("Selected Episodes are ", episodes)
         if args.threads == 0:
             threads = int(input("Enter number of threads to use "))
         else:
             threads = args.threads
+        compilations = []
         for episode in episodes:
             output_video_path = get_video_episode(anime_name, episode)
-            if not os.path.exists(output_video_path):
-                link = get_site_link(anime_name, int(episode),
-                                     args.quality, args.audio, anime_slug)
-                print(
-                    "\nGot the link for the episode {} of {}\n".format(
-                        episode, anime_name)
-                )
-                m3u8_link = get_playlist_link(link)
-                get_m3u8(anime_name, episode, m3u8_link)
-                print(
-                    "Got the link to download",
-                )
-                download_video(anime_name, episode, threads)
+            if os.path.basename(output_video_path) not in downloaded:
+                compilations.append(download_episode(
+                    anime_name, episode, args.quality, args.audio, anime_slug,
+                    threads))
             else:
                 print("{} epiosode {} already downloaded".format(
                     anime_name, episode))
+        shutdown_segment_pool()
+        for compilation in compilations:
+            if compilation is not None:
+                compilation.result()
         print("Downloading Finished!!!")
 
 
@@ -666,4 +965,8 @@ if __name__ == "__main__":
     parser.add_argument("-v", "--verbose", action="store_true", help="Logs")
 
     args = parser.parse_args()
+    logging.basicConfig(
+        format="%(levelname)s: %(message)s",
+        level=logging.DEBUG if args.verbose else logging.WARNING,
+    )
     main(args)